@@ -31,11 +31,11 @@ New features:
 
 import re
 import sys
+import functools
 
 import argparse
 
 RE_PARAM = re.compile(r"^\$[_a-zA-Z][_a-zA-Z0-9]*$")
-RE_SUB_PARAM = re.compile(r"\$(?P<var>[_a-zA-Z][_a-zA-Z0-9]*)")
 
 def warning(s):
     sys.stderr.write("Warning: %s\n" % s)
@@ -68,13 +68,17 @@ class Macro(object):
     def __init__(self, name, params, verbose, reuse):
         self.name = name
         self.params = params
+        # params are validated by RE_PARAM, so each one starts with "$"
+        self._param_names = [p[1:] for p in params]
+        # every "$var" in the body is scoped per expansion, except "$<name>"
+        # which carries the return value out of the macro
+        self._sub_re = re.compile(r"\$(?!%s(?![_a-zA-Z0-9]))(?P<var>[_a-zA-Z][_a-zA-Z0-9]*)" % name)
         self.verbose = verbose
         self.reuse = reuse
         self.lines = list()
         self.expand_id = 0
-
-    def add(self, line):
-        self.lines.append(line)
+        # whether the body references any var to scope, known at first expand
+        self._has_vars = None
 
     def _prefix(self):
         if self.reuse:
@@ -82,163 +86,231 @@ class Macro(object):
         else:
             return "__m%d_" % self.expand_id
 
-    def expand(self, args, call_line, lineno, indent):
-        ctx = list()
+    def expand(self, args, call_line, lineno, indent, emit):
         if len(self.params) != len(args):
             die("macro expand arguments mismatched at line: %d" % lineno)
 
-        var_prefix = self._prefix()
+        var_prefix = sys.intern(self._prefix())
+
+        if self._has_vars is None:
+            # the body is complete here: a macro is only callable after %end
+            search = self._sub_re.search
+            self._has_vars = any(search(line) for line in self.lines)
 
         # pass arguments
         if self.verbose:
-            ctx.append("\n%s// BEGIN: %s\n" % (indent, call_line.strip()))
+            emit(f"\n{indent}// BEGIN: {call_line.strip()}\n")
 
-        for (x, y) in zip(self.params, args):
-            ctx.append("%s%s%s%s = %s;\n" % (indent, x[0], var_prefix, x[1:], y))
+        for (name, y) in zip(self._param_names, args):
+            emit(f"{indent}${var_prefix}{name} = {y};\n")
 
         # expand body
+        # a callable, not a "\g<var>" template: the prefix differs per
+        # expansion and re would parse a new template every time
+        p = "$" + var_prefix
+        repl = lambda m: p + m.group("var")
         for line in self.lines:
-            #expanded_line = RE_SUB_PARAM.sub("$%s\\g<var>" % var_prefix, line)
-            expanded_line = self._expand_line(line, var_prefix)
-            ctx.append(expanded_line)
+            expanded_line = self._expand_line(line, repl)
+            emit(expanded_line)
 
         if self.verbose:
-            ctx.append("%s// END: %s\n" % (indent, call_line.strip()))
+            emit(f"{indent}// END: {call_line.strip()}\n")
 
         self.expand_id += 1
 
-        return "".join(ctx)
-
-    def _expand_line(self, line, var_prefix):
-        l = list()
-        start = 0
-        for m in RE_SUB_PARAM.finditer(line):
-            var = m.group(1)
-            if var != self.name:
-                l.append(line[start:m.start()])
-                l.append("$%s%s" % (var_prefix, var))
-                start = m.end()
-
-        if start < len(line):
-            l.append(line[start:])
-
-        return "".join(l)
+    def _expand_line(self, line, repl):
+        if not self._has_vars:
+            return line
+        if "$" not in line:
+            return line
+        return self._sub_re.sub(repl, line)
 
 class App(object):
-    RE_MACRO_START = re.compile(r"^\s*%macro\s+([_a-zA-Z][_a-zA-Z0-9]*)\s*\(([\s\$_A-Za-z0-9,]*)\)$")
-    RE_MACRO_END = re.compile(r"^\s*%end$")
-    RE_MACRO_CALL = re.compile(r"^(\s+)%call\s+([_a-zA-Z][_a-zA-Z0-9]*)\s*\(([\s\$_a-zA-Z0-9,]*)\)\s*;?$")
-    RE_MACRO_DEFINE = re.compile(r"^\s*%define\s+([_a-zA-Z][_A-Za-z0-9]*)\s+(.+)$")
+    # directive regexes match what follows the leading "%keyword"
+    RE_MACRO_START = re.compile(r"([_a-zA-Z][_a-zA-Z0-9]*)\s*\(([\s\$_A-Za-z0-9,]*)\)$")
+    RE_MACRO_CALL = re.compile(r"([_a-zA-Z][_a-zA-Z0-9]*)\s*\(([\s\$_a-zA-Z0-9,]*)\)\s*;?$")
+    RE_MACRO_DEFINE = re.compile(r"([_a-zA-Z][_A-Za-z0-9]*)\s+(.+)$")
+    # a whole identifier, as a define name is matched in a line
+    RE_IDENT = re.compile(r"(?<![_a-zA-Z0-9])[_a-zA-Z][_a-zA-Z0-9]*")
+
+    OUTPUT_BUFFER_SIZE = 1 << 20
+    # from this many defines on, scan identifiers instead of an alternation
+    DEFINES_SCAN_THRESHOLD = 64
 
     def __init__(self):
         self.opts = CommandLineParser().run()
+        # bumped on every defines change, the compiled pattern is rebuilt lazily
+        self._defines_version = 0
+        self._defines_cache = (None, None, None)
 
-    def parse_params(self, sparams, lineno):
+    def parse_params(self, sparams, lineno, unique=False):
         global RE_PARAM
         params = list()
-        names = dict()
+        names = set()
 
         s = sparams.strip()
         if len(s) == 0:
             return params
-        args = map(lambda v: v.strip(), s.split(","))
+        args = [a.strip() for a in s.split(",")]
+        param_match = RE_PARAM.match
         for arg in args:
-            m = RE_PARAM.match(arg)
+            m = param_match(arg)
             if m:
-                if arg in names:
-                    die("duplicated parameter name (%s) at line: %d" % (arg, lineno))
+                if unique:
+                    if arg in names:
+                        die("duplicated parameter name (%s) at line: %d" % (arg, lineno))
+                    names.add(arg)
                 params.append(arg)
             else:
                 die("invalid parameter name (%s) at line: %d" % (arg, lineno))
 
         return params
 
+    def _specialize_defines(self, defines):
+        version, expand_fn, first_chars = self._defines_cache
+        if version != self._defines_version:
+            # the expander (pattern, lookup and replacement callback) is
+            # built once per defines version instead of once per line
+            ident = self.RE_IDENT.fullmatch
+            if len(defines) >= self.DEFINES_SCAN_THRESHOLD and all(ident(k) for k in defines):
+                # the alternation backtracks through every key at each
+                # position; with many keys a single pass over identifiers
+                # with a dict lookup is linear in the line instead
+                get = defines.get
+                expand_fn = functools.partial(self.RE_IDENT.sub, lambda m: get(m.group(0), m.group(0)))
+            else:
+                # longest first, so a key never shadows a longer one it prefixes
+                keys = sorted(defines, key=len, reverse=True)
+                pattern = re.compile(r"(?<![_a-zA-Z0-9])(?:%s)(?![_a-zA-Z0-9])" % "|".join(map(re.escape, keys)))
+                get = defines.__getitem__
+                expand_fn = functools.partial(pattern.sub, lambda m: get(m.group(0)))
+            first_chars = frozenset(k[0] for k in defines)
+            self._defines_cache = (self._defines_version, expand_fn, first_chars)
+        return expand_fn, first_chars
+
     def expand_defines(self, line, defines):
-        s = line
-        for k, v in defines.items():
-            s = s.replace(k, v)
-        return s
-            
+        if not defines:
+            return line
+        expand_fn, first_chars = self._specialize_defines(defines)
+        # no define can start anywhere in this line
+        if first_chars.isdisjoint(line):
+            return line
+        return expand_fn(line)
+
     def _init_pre_defines(self, predefines):
         defines = dict()
         for d in predefines:
-            k, v = map(lambda x: x.strip(), d.split("=", 1))
+            parts = d.split("=", 1)
+            k = parts[0].strip()
+            v = parts[1].strip() if len(parts) == 2 else ""
             if k == "" or v == "":
                 continue
             if k in defines:
                 warning("overwrite pre-define %s to value %s" % (k, v))
             defines[k] = v
+            self._defines_version += 1
         return defines
             
     def compile_script(self, input, output, predefines, verbose, reuse):
         macros = dict()
-        context = list()
+        # the compiled script is collected as encoded bytes and written once
+        context = bytearray()
+
+        # set from the input file, the output is encoded the same way
+        encoding = None
+
+        def emit(chunk):
+            context.extend(chunk.encode(encoding))
+
+        def emit_line(new_line):
+            # ignore empty line
+            if len(new_line.strip()) != 0:
+                emit(new_line)
+
+        # lines go to the output, or to the body of the macro being defined;
+        # both are switched on %macro/%end instead of checked per line
         current_macro = None
+        add_line = emit_line
+        add_expanded = emit
         defines = self._init_pre_defines(predefines)
+        expand_defines = self.expand_defines
+        # bind the directive matchers once, they are the per-line hot path
+        macro_start = self.RE_MACRO_START.match
+        macro_call = self.RE_MACRO_CALL.match
+        macro_define = self.RE_MACRO_DEFINE.match
         with open(input) as fp:
-            for lineno, line in enumerate(fp.readlines(), 1):
-                s = line.rstrip()
-                m = self.RE_MACRO_START.match(s)
-                if m:
-                    name, sp = m.group(1), m.group(2)
-                    if current_macro is not None:
-                        die("define nested macro (%s) in macro (%s) at line: %d" % (name, current_macro.name, lineno))
-
-                    params = self.parse_params(sp, lineno)
-                    current_macro = Macro(name, params, verbose, reuse)
-                    continue
-
-                m = self.RE_MACRO_END.match(s)
-                if m:
-                    if current_macro is None:
-                        die("macro end is mismatched macro start at line: %d" % lineno)
-
-                    name = current_macro.name
-                    if name in macros:
-                        die("found duplicated macro (%s) at line: %d" % (name, lineno))
-
-                    macros[name] = current_macro
-                    current_macro = None
-                    continue
-
-                m = self.RE_MACRO_CALL.match(s)
-                if m:
-                    indent, name, sp = m.group(1), m.group(2), m.group(3)
-                    args = self.parse_params(sp, lineno)
-
-                    if current_macro is not None and current_macro.name == name:
-                        die("forbidden to call function macro (%s) recursively at line: %d" % (name, lineno))
-
-                    expand_macro = macros.get(name, None)
-                    if expand_macro is None:
-                        die("call an unknown macro (%s) at line: %d" % (name, lineno))
-
-                    new_line = expand_macro.expand(args, s, lineno, indent)
-                    if current_macro is None:
-                        context.append(new_line)
-                    else:
-                        current_macro.add(new_line)
-                    continue
-
-                m = self.RE_MACRO_DEFINE.match(s)
-                if m:
-                    name, value = m.group(1), m.group(2)
-                    if name in defines:
-                        warning("redefine item (%s) will be overwritten at line: %d" % (name, lineno))
-                    defines[name] = value
-                    continue
-
-                new_line = self.expand_defines(line, defines)
-
-                if current_macro is None:
-                    # ignore empty line
-                    if len(new_line.strip()) != 0:
-                        context.append(new_line)
-                else:
-                    current_macro.add(new_line)
-
-            with open(output, "w") as fp:
-                fp.write("".join(context))
+            encoding = fp.encoding
+            for lineno, line in enumerate(fp, 1):
+                head = line.lstrip()
+                # only a line led by "%" can be a directive, a directive with
+                # invalid syntax passes through as an ordinary line
+                if head.startswith("%"):
+                    parts = head.split(None, 1)
+                    kw = parts[0]
+                    rest = parts[1].rstrip() if len(parts) == 2 else ""
+
+                    if kw == "%macro":
+                        m = macro_start(rest)
+                        if m:
+                            name, sp = m.group(1), m.group(2)
+                            if current_macro is not None:
+                                die("define nested macro (%s) in macro (%s) at line: %d" % (name, current_macro.name, lineno))
+
+                            params = self.parse_params(sp, lineno, unique=True)
+                            current_macro = Macro(name, params, verbose, reuse)
+                            add_line = add_expanded = current_macro.lines.append
+                            continue
+
+                    elif kw == "%end":
+                        if len(rest) == 0:
+                            if current_macro is None:
+                                die("macro end is mismatched macro start at line: %d" % lineno)
+
+                            name = current_macro.name
+                            if name in macros:
+                                die("found duplicated macro (%s) at line: %d" % (name, lineno))
+
+                            macros[name] = current_macro
+                            current_macro = None
+                            add_line = emit_line
+                            add_expanded = emit
+                            continue
+
+                    elif kw == "%call":
+                        # a call keeps its indent, so it must have one
+                        indent = line[:len(line) - len(head)]
+                        m = macro_call(rest)
+                        if m and len(indent) != 0:
+                            name, sp = m.group(1), m.group(2)
+                            args = self.parse_params(sp, lineno)
+
+                            if current_macro is not None and current_macro.name == name:
+                                die("forbidden to call function macro (%s) recursively at line: %d" % (name, lineno))
+
+                            expand_macro = macros.get(name, None)
+                            if expand_macro is None:
+                                die("call an unknown macro (%s) at line: %d" % (name, lineno))
+
+                            expand_macro.expand(args, head, lineno, indent, add_expanded)
+                            continue
+
+                    elif kw == "%define":
+                        m = macro_define(rest)
+                        if m:
+                            name, value = m.group(1), m.group(2)
+                            if name in defines:
+                                warning("redefine item (%s) will be overwritten at line: %d" % (name, lineno))
+                            defines[name] = value
+                            self._defines_version += 1
+                            continue
+
+                add_line(expand_defines(line, defines))
+
+            if current_macro is not None:
+                die("macro (%s) is not ended at end of file" % current_macro.name)
+
+            with open(output, "wb", buffering=self.OUTPUT_BUFFER_SIZE) as fp:
+                fp.write(context)
 
             print("[Success] new compiled script %s has been generated!" % output)
 